@@ -1,15 +1,19 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import yfinance as yf
 from datetime import datetime, timedelta
-import plotly.graph_objects as go
-import plotly.express as px
+import scipy.stats as stats
 import sqlite3
 import os
+import io
 import json
+import glob
 from pathlib import Path
 import pickle
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -24,8 +28,200 @@ st.set_page_config(
 # 创建必要的目录
 DATA_DIR = Path("data")
 MODELS_DIR = Path("models")
+PARQUET_DIR = DATA_DIR / "parquet"
 DATA_DIR.mkdir(exist_ok=True)
 MODELS_DIR.mkdir(exist_ok=True)
+PARQUET_DIR.mkdir(exist_ok=True)
+
+# yfinance批量下载时每次请求的股票数量上限
+DOWNLOAD_BATCH_SIZE = 20
+
+# 图表数据点超过上限时降采样到目标点数
+PLOT_MAX_POINTS = 4000
+PLOT_TARGET_POINTS = 2000
+
+# 后台预取：最近查看的股票数量与并发预取任务数
+PREFETCH_TOP_K = 4
+PREFETCH_WORKERS = 2
+
+# 系统设置文件及其默认值
+SETTINGS_PATH = DATA_DIR / "settings.json"
+DEFAULT_SETTINGS = {
+    'cache_enabled': True,
+    'cache_duration': 7,
+    'auto_update': False,
+    'update_time': None
+}
+
+@st.cache_resource
+def _get_conn(db_path, readonly):
+    """获取跨rerun复用的数据库连接（只读连接与写连接各缓存一个）"""
+    mode = 'ro' if readonly else 'rwc'
+    conn = sqlite3.connect(
+        f"{Path(db_path).resolve().as_uri()}?mode={mode}",
+        uri=True,
+        check_same_thread=False,
+        timeout=5,
+        isolation_level=None
+    )
+    # 连接级设置，每个连接都需单独设置
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA foreign_keys=ON")
+    # ANALYZE每个索引最多抽样约1000行，统计信息足够选索引，耗时与表大小基本无关
+    conn.execute("PRAGMA analysis_limit=1000")
+    return conn
+
+@st.cache_resource
+def _get_write_lock(db_path):
+    """写连接的锁：与写连接一样在进程内所有会话间共享，SQLite同一时刻只允许一个写者"""
+    return threading.Lock()
+
+class _PrefetchQueue:
+    """后台预取队列：固定数量的工作线程依次执行，同一任务在完成前不重复提交"""
+    
+    def __init__(self, max_workers):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._pending = set()
+        self._lock = threading.Lock()
+    
+    def submit(self, key, fn, *args):
+        """提交任务；key相同的任务仍在排队或执行时直接跳过"""
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        future = self._pool.submit(fn, *args)
+        future.add_done_callback(lambda _: self._discard(key))
+    
+    def _discard(self, key):
+        with self._lock:
+            self._pending.discard(key)
+
+@st.cache_resource
+def _get_prefetch_queue():
+    """预取队列：进程内所有会话共享同一个线程池"""
+    return _PrefetchQueue(PREFETCH_WORKERS)
+
+def _db_mtime(db_path):
+    """数据库最后修改时间，用作读缓存的失效键（WAL模式下写入先落在-wal文件中）"""
+    mtimes = [os.stat(path).st_mtime_ns for path in (str(db_path), f"{db_path}-wal") if os.path.exists(path)]
+    return max(mtimes, default=0)
+
+def _parquet_path(symbol, count, last_date):
+    """股票的parquet缓存文件路径，文件名带该股票的记录数与最新日期作为版本"""
+    return PARQUET_DIR / f"{symbol}@{count}@{str(last_date)[:10]}.parquet"
+
+def _parquet_files(symbol):
+    """股票的所有版本的parquet缓存文件"""
+    return [
+        path for path in PARQUET_DIR.glob(f"{glob.escape(symbol)}@*.parquet")
+        if path.stem.rsplit("@", 2)[0] == symbol
+    ]
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _load_stock_df(db_path, symbol, start_date, end_date, mtime):
+    """读取单只股票的历史数据（数据库修改后缓存自动失效）"""
+    conn = _get_conn(db_path, True)
+    
+    # 完整历史优先读取parquet文件缓存；只有这只股票的记录数或最新日期变化才使文件失效
+    full_history = not start_date and not end_date
+    if full_history:
+        count, last_date = conn.execute(
+            "SELECT COUNT(*), MAX(date) FROM stocks WHERE symbol = ?", (symbol,)
+        ).fetchone()
+        cache_path = _parquet_path(symbol, count, last_date)
+        if count and cache_path.exists():
+            try:
+                return pd.read_parquet(cache_path, engine='pyarrow')
+            except Exception:
+                pass
+    
+    # 使用参数占位符，SQLite可复用已编译的语句
+    query = (
+        "SELECT date, open, high, low, close, volume, dividends, stock_splits "
+        "FROM stocks WHERE symbol = ?"
+    )
+    params = [symbol]
+    if start_date:
+        query += " AND date >= ?"
+        params.append(str(start_date))
+    if end_date:
+        query += " AND date <= ?"
+        params.append(str(end_date))
+    query += " ORDER BY date"
+    
+    data = pd.read_sql_query(
+        query, conn, params=params,
+        parse_dates=['date'], index_col='date'
+    )
+    
+    if not data.empty:
+        data.index.name = 'Date'
+        # 将列名转换为首字母大写，以匹配后续代码
+        data.columns = [col.capitalize() for col in data.columns]
+        if 'Stock_splits' in data.columns:
+            data.rename(columns={'Stock_splits': 'Stock Splits'}, inplace=True)
+        
+        if full_history:
+            # 版本取自读到的数据本身，读取期间即使有新写入，文件名也与内容一致
+            cache_path = _parquet_path(symbol, len(data), data.index[-1].date())
+            # 先写临时文件再替换，避免其他会话读到写了一半的文件
+            tmp_path = PARQUET_DIR / f".{symbol}.{threading.get_ident()}.tmp"
+            try:
+                data.to_parquet(tmp_path, engine='pyarrow', compression='zstd')
+                os.replace(tmp_path, cache_path)
+                for stale_path in _parquet_files(symbol):
+                    if stale_path != cache_path:
+                        stale_path.unlink(missing_ok=True)
+            except Exception:
+                tmp_path.unlink(missing_ok=True)
+    
+    return data
+
+@st.cache_data(show_spinner=False)
+def _load_stored_symbols(db_path, mtime):
+    """读取已存储的股票代码列表"""
+    query = "SELECT DISTINCT symbol FROM stocks ORDER BY symbol"
+    symbols = pd.read_sql_query(query, _get_conn(db_path, True))
+    return symbols['symbol'].tolist()
+
+@st.cache_data(show_spinner=False)
+def _load_data_summary(db_path, mtime):
+    """读取数据统计摘要"""
+    # 单次查询取回全部统计值；MIN/MAX分别作为标量子查询，才能直接读取date索引的两端
+    stock_count, record_count, start_date, end_date = _get_conn(db_path, True).execute('''
+    SELECT
+        (SELECT COUNT(DISTINCT symbol) FROM stocks),
+        (SELECT COUNT(*) FROM stocks),
+        (SELECT MIN(date) FROM stocks),
+        (SELECT MAX(date) FROM stocks)
+    ''').fetchone()
+    
+    return {
+        'stock_count': stock_count,
+        'record_count': record_count,
+        'start_date': start_date,
+        'end_date': end_date
+    }
+
+def _settings_mtime():
+    """设置文件最后修改时间，文件不存在时为0"""
+    return SETTINGS_PATH.stat().st_mtime_ns if SETTINGS_PATH.exists() else 0
+
+@st.cache_data(show_spinner=False)
+def _load_settings(mtime):
+    """读取系统设置，缺失或损坏的字段使用默认值"""
+    settings = dict(DEFAULT_SETTINGS)
+    if mtime:
+        try:
+            with open(SETTINGS_PATH) as f:
+                settings.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return settings
 
 class DataManager:
     """数据管理类"""
@@ -33,12 +229,26 @@ class DataManager:
     def __init__(self):
         self.db_path = DATA_DIR / "stocks.db"
         self.init_database()
+        self._read = _get_conn(str(self.db_path), True)
+        self._write = _get_conn(str(self.db_path), False)
+        # 所有对写连接的使用都需持有此锁
+        self._write_lock = _get_write_lock(str(self.db_path))
+        # 后台预取队列，同时最多执行PREFETCH_WORKERS个预取任务，其余排队
+        self._prefetch_queue = _get_prefetch_queue()
     
     def init_database(self):
         """初始化数据库"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
+        # 增量回收空闲页，必须在建表前设置才对新库生效（旧库需执行一次完整VACUUM）
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        
+        # WAL模式写入数据库文件头，只需设置一次；内存数据库不支持WAL
+        # （其余PRAGMA为连接级设置，在_get_conn中对长期复用的连接设置）
+        if str(self.db_path) != ':memory:':
+            cursor.execute("PRAGMA journal_mode=WAL")
+        
         # 创建股票数据表
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS stocks (
@@ -56,6 +266,15 @@ class DataManager:
         )
         ''')
         
+        # 覆盖索引：按股票读取日期区间时只需扫描索引，无需回表
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_stocks_symbol_date_cover 
+        ON stocks(symbol, date, open, high, low, close, volume, dividends, stock_splits)
+        ''')
+        
+        # 日期索引：数据摘要中的MIN/MAX(date)直接读取索引两端
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_stocks_date ON stocks(date)')
+        
         # 创建股票信息表
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS stock_info (
@@ -71,46 +290,107 @@ class DataManager:
         conn.commit()
         conn.close()
     
+    @contextmanager
+    def _transaction(self):
+        """写事务：持有写锁，正常结束时提交，异常时回滚"""
+        with self._write_lock:
+            self._write.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._write
+            except Exception:
+                self._write.execute("ROLLBACK")
+                raise
+            self._write.execute("COMMIT")
+    
+    def _download_history(self, symbols, start_date, end_date, interval):
+        """一次请求批量下载多只股票的历史数据，并按股票代码拆分"""
+        import yfinance as yf
+        
+        df = yf.download(
+            " ".join(symbols),
+            start=start_date,
+            end=end_date,
+            interval=interval,
+            group_by='ticker',
+            threads=True,
+            progress=False,
+            auto_adjust=True,
+            actions=True
+        )
+        
+        history = {}
+        if df is None or df.empty:
+            return history
+        
+        for symbol in symbols:
+            if isinstance(df.columns, pd.MultiIndex):
+                if symbol not in df.columns.get_level_values(0):
+                    continue
+                data = df[symbol]
+            else:
+                data = df
+            
+            data = data.dropna(subset=['Close']).copy()
+            if not data.empty:
+                data['Symbol'] = symbol
+                history[symbol] = data
+        
+        return history
+    
+    def _fetch_info(self, symbol):
+        """获取单只股票的基本信息（在工作线程中执行，不调用Streamlit）"""
+        import yfinance as yf
+        
+        info = yf.Ticker(symbol).info
+        return {
+            'symbol': symbol,
+            'name': info.get('longName', symbol),
+            'sector': info.get('sector', 'Unknown'),
+            'industry': info.get('industry', 'Unknown'),
+            'market_cap': info.get('marketCap', 0),
+            'last_updated': datetime.now().date()
+        }
+    
     def fetch_stock_data(self, symbols, start_date, end_date, interval='1d'):
         """从yfinance获取股票数据"""
         try:
             # 处理多个股票代码
             if isinstance(symbols, str):
                 symbols = [s.strip().upper() for s in symbols.split(',')]
+            symbols = list(dict.fromkeys(s for s in symbols if s))
             
             all_data = {}
+            if not symbols:
+                return all_data
             
-            for symbol in symbols:
+            # 历史数据按批次合并为一次请求
+            for i in range(0, len(symbols), DOWNLOAD_BATCH_SIZE):
+                batch = symbols[i:i + DOWNLOAD_BATCH_SIZE]
                 try:
-                    ticker = yf.Ticker(symbol)
-                    
-                    # 获取历史数据
-                    data = ticker.history(start=start_date, end=end_date, interval=interval)
-                    
-                    if not data.empty:
-                        data['Symbol'] = symbol
-                        all_data[symbol] = data
-                        
-                        # 获取股票基本信息
-                        info = ticker.info
-                        stock_info = {
-                            'symbol': symbol,
-                            'name': info.get('longName', symbol),
-                            'sector': info.get('sector', 'Unknown'),
-                            'industry': info.get('industry', 'Unknown'),
-                            'market_cap': info.get('marketCap', 0),
-                            'last_updated': datetime.now().date()
-                        }
-                        
-                        # 保存股票信息
-                        self.save_stock_info(stock_info)
-                        
-                        st.success(f"成功获取 {symbol} 的数据 ({len(data)} 条记录)")
-                    else:
-                        st.warning(f"未找到 {symbol} 的数据")
-                        
+                    all_data.update(self._download_history(batch, start_date, end_date, interval))
                 except Exception as e:
-                    st.error(f"获取 {symbol} 数据时出错: {str(e)}")
+                    st.error(f"获取 {', '.join(batch)} 数据时出错: {str(e)}")
+            
+            for symbol in symbols:
+                if symbol in all_data:
+                    st.success(f"成功获取 {symbol} 的数据 ({len(all_data[symbol])} 条记录)")
+                else:
+                    st.warning(f"未找到 {symbol} 的数据")
+            
+            if not all_data:
+                return all_data
+            
+            # 基本信息接口只能逐只请求，多线程并发获取；数据库写入留在主线程
+            with ThreadPoolExecutor(max_workers=min(16, len(all_data))) as executor:
+                futures = {executor.submit(self._fetch_info, symbol): symbol for symbol in all_data}
+                
+                for future in as_completed(futures):
+                    symbol = futures[future]
+                    try:
+                        # 保存股票信息
+                        self.save_stock_info(future.result())
+                    except Exception as e:
+                        st.error(f"获取 {symbol} 基本信息时出错: {str(e)}")
             
             return all_data
             
@@ -121,16 +401,12 @@ class DataManager:
     def save_stock_data(self, symbol, data):
         """保存股票数据到数据库"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            
             # 准备数据
             data = data.reset_index()
             if 'Date' in data.columns:
-                data['date'] = data['Date'].dt.date
+                data['date'] = data['Date'].dt.tz_localize(None)
             elif 'Datetime' in data.columns:
-                data['date'] = data['Datetime'].dt.date
-            
-            data['symbol'] = symbol
+                data['date'] = data['Datetime'].dt.tz_localize(None)
 
             rename_map = {
                 'Open': 'open',
@@ -143,43 +419,52 @@ class DataManager:
             }
             data.rename(columns=rename_map, inplace=True)
             
-            # 筛选出数据库中存在的列
-            db_columns = ['symbol', 'date', 'open', 'high', 'low', 'close', 'volume', 'dividends', 'stock_splits']
-            data_to_save = data[[col for col in db_columns if col in data.columns]]
+            # 按列整体转换为Python原生值再拼成行，避免逐行装箱；缺失的列以空值补齐
+            value_columns = ['open', 'high', 'low', 'close', 'volume', 'dividends', 'stock_splits']
+            data_to_save = data.reindex(columns=['date'] + value_columns)
+            dates = data_to_save['date'].to_numpy().astype('datetime64[D]').astype(str).tolist()
+            values = [data_to_save[col].to_numpy().tolist() for col in value_columns]
+            rows = list(zip([symbol] * len(dates), dates, *values))
             
-            # 保存到数据库
-            data.to_sql('stocks', conn, if_exists='append', index=False, 
-                       method='multi', chunksize=1000)
+            # 单个事务批量写入，已存在的(symbol, date)记录直接跳过
+            with self._transaction() as conn:
+                conn.executemany('''
+                INSERT OR IGNORE INTO stocks 
+                (symbol, date, open, high, low, close, volume, dividends, stock_splits)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
             
-            conn.commit()
-            conn.close()
             return True
             
         except Exception as e:
             st.error(f"保存数据时出错: {str(e)}")
             return False
     
+    def analyze_database(self):
+        """更新查询优化器的统计信息（批量保存结束后调用一次；按analysis_limit抽样，不扫描全表）"""
+        try:
+            with self._write_lock:
+                self._write.execute("ANALYZE stocks")
+        except Exception as e:
+            st.warning(f"更新统计信息失败: {str(e)}")
+    
     def save_stock_info(self, stock_info):
         """保存股票信息"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            
-            cursor = conn.cursor()
-            cursor.execute('''
-            INSERT OR REPLACE INTO stock_info 
-            (symbol, name, sector, industry, market_cap, last_updated)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                stock_info['symbol'],
-                stock_info['name'],
-                stock_info['sector'],
-                stock_info['industry'],
-                stock_info['market_cap'],
-                stock_info['last_updated']
-            ))
+            with self._write_lock:
+                self._write.execute('''
+                INSERT OR REPLACE INTO stock_info 
+                (symbol, name, sector, industry, market_cap, last_updated)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ''', (
+                    stock_info['symbol'],
+                    stock_info['name'],
+                    stock_info['sector'],
+                    stock_info['industry'],
+                    stock_info['market_cap'],
+                    stock_info['last_updated']
+                ))
             
-            conn.commit()
-            conn.close()
             return True
             
         except Exception as e:
@@ -188,51 +473,35 @@ class DataManager:
     def get_stored_symbols(self):
         """获取数据库中已存储的股票代码"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            query = "SELECT DISTINCT symbol FROM stocks ORDER BY symbol"
-            symbols = pd.read_sql_query(query, conn)
-            conn.close()
-            return symbols['symbol'].tolist()
+            return _load_stored_symbols(str(self.db_path), _db_mtime(self.db_path))
         except:
             return []
     
     def get_stock_data(self, symbol, start_date=None, end_date=None):
         """从数据库获取股票数据"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            
-            query = f"SELECT * FROM stocks WHERE symbol = '{symbol}'"
-            if start_date:
-                query += f" AND date >= '{start_date}'"
-            if end_date:
-                query += f" AND date <= '{end_date}'"
-            query += " ORDER BY date"
-            
-            data = pd.read_sql_query(query, conn)
-            
-            if not data.empty:
-                data['date'] = pd.to_datetime(data['date'])
-                data.set_index('date', inplace=True)
-                data.index.name = 'Date'
-                # 将列名转换为首字母大写，以匹配后续代码
-                data.columns = [col.capitalize() for col in data.columns]
-                if 'Stock_splits' in data.columns:
-                    data.rename(columns={'Stock_splits': 'Stock Splits'}, inplace=True)
-            
-            conn.close()
-            return data
+            return _load_stock_df(
+                str(self.db_path), symbol, start_date, end_date, _db_mtime(self.db_path)
+            )
             
         except Exception as e:
             st.error(f"读取数据时出错: {str(e)}")
             return pd.DataFrame()
     
+    def prefetch_stock_data(self, symbols):
+        """在后台线程中预取股票数据，预热读缓存（全部候选排队执行，已在排队的不重复提交）"""
+        db_path = str(self.db_path)
+        mtime = _db_mtime(self.db_path)
+        for symbol in symbols:
+            self._prefetch_queue.submit(
+                (db_path, symbol, mtime), _load_stock_df, db_path, symbol, None, None, mtime
+            )
+    
     def get_stock_info(self, symbol):
         """获取股票信息"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            query = f"SELECT * FROM stock_info WHERE symbol = '{symbol}'"
-            info = pd.read_sql_query(query, conn)
-            conn.close()
+            query = "SELECT * FROM stock_info WHERE symbol = ?"
+            info = pd.read_sql_query(query, self._read, params=(symbol,))
             return info.iloc[0].to_dict() if not info.empty else {}
         except:
             return {}
@@ -240,75 +509,172 @@ class DataManager:
     def delete_stock_data(self, symbol):
         """删除指定股票的所有数据"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM stocks WHERE symbol = ?", (symbol,))
-            cursor.execute("DELETE FROM stock_info WHERE symbol = ?", (symbol,))
-            conn.commit()
-            conn.close()
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM stocks WHERE symbol = ?", (symbol,))
+                conn.execute("DELETE FROM stock_info WHERE symbol = ?", (symbol,))
+            for cache_path in _parquet_files(symbol):
+                cache_path.unlink(missing_ok=True)
             return True
         except Exception as e:
             st.error(f"删除数据时出错: {str(e)}")
             return False
     
+    def clear_all_data(self):
+        """清空所有股票数据"""
+        try:
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM stocks")
+                conn.execute("DELETE FROM stock_info")
+            for cache_path in PARQUET_DIR.glob("*.parquet"):
+                cache_path.unlink(missing_ok=True)
+            return True
+        except Exception as e:
+            st.error(f"清空失败: {str(e)}")
+            return False
+    
+    def vacuum_database(self, pages=1000, full=False):
+        """整理数据库文件：默认增量回收至多pages个空闲页；full=True时完整重建数据库（较慢）"""
+        try:
+            with self._write_lock:
+                if full:
+                    # 完整VACUUM会按当前auto_vacuum设置重建，旧库借此启用增量回收
+                    self._write.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                    self._write.execute("VACUUM")
+                else:
+                    # executescript会执行到底；execute只单步执行，每次仅回收一页
+                    self._write.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+            return True
+        except Exception as e:
+            st.error(f"优化失败: {str(e)}")
+            return False
+    
     def get_data_summary(self):
         """获取数据统计摘要"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            
-            # 获取股票数量
-            stock_count = pd.read_sql_query(
-                "SELECT COUNT(DISTINCT symbol) as count FROM stocks", conn
-            ).iloc[0]['count']
-            
-            # 获取记录总数
-            record_count = pd.read_sql_query(
-                "SELECT COUNT(*) as count FROM stocks", conn
-            ).iloc[0]['count']
-            
-            # 获取数据日期范围
-            date_range = pd.read_sql_query(
-                "SELECT MIN(date) as start_date, MAX(date) as end_date FROM stocks", conn
-            )
-            
-            conn.close()
-            
-            return {
-                'stock_count': stock_count,
-                'record_count': record_count,
-                'start_date': date_range.iloc[0]['start_date'],
-                'end_date': date_range.iloc[0]['end_date']
-            }
-            
+            return _load_data_summary(str(self.db_path), _db_mtime(self.db_path))
         except:
             return {}
 
+def _window_sums(values, window):
+    """各长度为window的滑动窗口之和（前缀和相减，O(N)）"""
+    csum = np.cumsum(values)
+    sums = csum[window - 1:].copy()
+    sums[1:] -= csum[:-window]
+    return sums
+
+def _rolling_mean(values, window):
+    """滚动均值（输入不含NaN），前window-1个位置为NaN（与pandas的rolling(window).mean()一致）"""
+    result = np.full(len(values), np.nan)
+    if len(values) >= window:
+        result[window - 1:] = _window_sums(values, window) / window
+    return result
+
+def _rolling_mean_std(values, window):
+    """由窗口和与平方和计算滚动均值和样本标准差（ddof=1，窗口内含NaN时为NaN，与pandas一致）"""
+    mean = np.full(len(values), np.nan)
+    std = np.full(len(values), np.nan)
+    if len(values) >= window:
+        missing = np.isnan(values)
+        has_missing = missing.any()
+        # 先减去整体均值再累加，避免平方和相减时损失精度；缺失值按0累加，最后整窗置为NaN
+        if has_missing:
+            center = values[~missing].mean() if not missing.all() else 0.0
+        else:
+            center = values.mean()
+        shifted = values - center
+        if has_missing:
+            shifted[missing] = 0.0
+        sums = _window_sums(shifted, window)
+        sq_sums = _window_sums(shifted * shifted, window)
+        mean[window - 1:] = sums / window + center
+        std[window - 1:] = np.sqrt(np.maximum(sq_sums - sums * sums / window, 0.0) / (window - 1))
+        if has_missing:
+            incomplete = np.flatnonzero(_window_sums(missing, window)) + window - 1
+            mean[incomplete] = np.nan
+            std[incomplete] = np.nan
+    return mean, std
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _probplot(returns):
+    """正态Q-Q图的理论分位数与拟合线（相同收益率序列跨rerun复用）"""
+    return stats.probplot(returns, dist="norm")
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _lttb_indices(values, n_out):
+    """LTTB（Largest-Triangle-Three-Buckets）降采样，返回保留点的位置索引
+    （按数组内容缓存：同一次rerun中多个图表共用同一列，以及数据未变的rerun，都不再重复计算）"""
+    n = len(values)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    
+    y = np.asarray(values, dtype=float)
+    if np.isnan(y).any():
+        y = np.nan_to_num(y, nan=np.nanmean(y) if not np.isnan(y).all() else 0.0)
+    x = np.arange(n, dtype=float)
+    
+    # 首尾点固定保留，中间n-2个点均分为n_out-2个桶，每桶选出与相邻点构成三角形面积最大的点
+    bucket_size = (n - 2) / (n_out - 2)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+@functools.cache
+def _fmt_mcap(value):
+    """格式化市值显示（结果按数值缓存）"""
+    if value > 1e9:
+        return f"${value/1e9:.2f}B"
+    if value > 1e6:
+        return f"${value/1e6:.2f}M"
+    return str(value)
+
+def _downsample(data, column):
+    """数据点过多时按指定列做LTTB降采样，减少传给浏览器的图表数据量"""
+    if len(data) <= PLOT_MAX_POINTS:
+        return data
+    return data.iloc[_lttb_indices(data[column].to_numpy(), PLOT_TARGET_POINTS)]
+
 class StockVisualizer:
     """股票数据可视化类"""
     
     @staticmethod
     def plot_price_chart(data, symbol):
         """绘制价格图表"""
+        import plotly.graph_objects as go
+        
         if data.empty:
             return None
             
         fig = go.Figure()
         
+        # 移动平均线基于完整数据计算，绘图时再降采样
+        if len(data) > 20:
+            data['MA20'] = data['Close'].rolling(window=20).mean()
+        plot_data = _downsample(data, 'Close')
+        
         # 添加收盘价线
         fig.add_trace(go.Scatter(
-            x=data.index,
-            y=data['Close'],
+            x=plot_data.index,
+            y=plot_data['Close'],
             mode='lines',
             name='Close Price',
             line=dict(color='#1f77b4', width=2)
         ))
         
         # 添加移动平均线
-        if len(data) > 20:
-            data['MA20'] = data['Close'].rolling(window=20).mean()
+        if 'MA20' in plot_data.columns:
             fig.add_trace(go.Scatter(
-                x=data.index,
-                y=data['MA20'],
+                x=plot_data.index,
+                y=plot_data['MA20'],
                 mode='lines',
                 name='20-Day MA',
                 line=dict(color='orange', width=1.5, dash='dash')
@@ -329,18 +695,20 @@ class StockVisualizer:
     @staticmethod
     def plot_volume_chart(data, symbol):
         """绘制交易量图表"""
+        import plotly.graph_objects as go
+        
         if data.empty:
             return None
             
         fig = go.Figure()
+        plot_data = _downsample(data, 'Volume')
         
         # 创建颜色映射：上涨为绿色，下跌为红色
-        colors = ['red' if data['Close'].iloc[i] < data['Open'].iloc[i] else 'green' 
-                 for i in range(len(data))]
+        colors = np.where(plot_data['Close'].to_numpy() < plot_data['Open'].to_numpy(), 'red', 'green').tolist()
         
         fig.add_trace(go.Bar(
-            x=data.index,
-            y=data['Volume'],
+            x=plot_data.index,
+            y=plot_data['Volume'],
             name='Volume',
             marker_color=colors,
             opacity=0.7
@@ -360,21 +728,24 @@ class StockVisualizer:
     @staticmethod
     def plot_technical_indicators(data, symbol):
         """绘制技术指标"""
+        import plotly.graph_objects as go
+        
         if data.empty or len(data) < 50:
             return None
             
         fig = go.Figure()
         
-        # 计算RSI
-        delta = data['Close'].diff()
-        gain = (delta.where(delta > 0, 0)).rolling(window=14).mean()
-        loss = (-delta.where(delta < 0, 0)).rolling(window=14).mean()
-        rs = gain / loss
-        data['RSI'] = 100 - (100 / (1 + rs))
+        # 计算RSI：RSI = 100 - 100/(1 + gain/loss) = 100 * gain/(gain + loss)
+        delta = np.diff(data['Close'].to_numpy(dtype=float), prepend=np.nan)
+        gain = _rolling_mean(np.where(delta > 0, delta, 0.0), 14)
+        loss = _rolling_mean(np.where(delta < 0, -delta, 0.0), 14)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            data['RSI'] = 100 * gain / (gain + loss)
+        plot_data = _downsample(data, 'RSI')
         
         fig.add_trace(go.Scatter(
-            x=data.index,
-            y=data['RSI'],
+            x=plot_data.index,
+            y=plot_data['RSI'],
             mode='lines',
             name='RSI',
             line=dict(color='purple', width=2)
@@ -411,12 +782,7 @@ class StockVisualizer:
         with col3:
             st.metric("行业板块", info.get('sector', 'N/A'))
         with col4:
-            market_cap = info.get('market_cap', 0)
-            if market_cap > 1e9:
-                market_cap = f"${market_cap/1e9:.2f}B"
-            elif market_cap > 1e6:
-                market_cap = f"${market_cap/1e6:.2f}M"
-            st.metric("市值", market_cap)
+            st.metric("市值", _fmt_mcap(info.get('market_cap', 0)))
 
 class StockAnalysisSystem:
     """主系统类"""
@@ -469,6 +835,12 @@ class StockAnalysisSystem:
         elif page == "系统设置":
             self.system_settings_page()
     
+    @staticmethod
+    def remember_symbol(symbol):
+        """记录最近查看的股票，供预取使用"""
+        recent = [s for s in st.session_state.get('recent_symbols', []) if s != symbol]
+        st.session_state['recent_symbols'] = [symbol] + recent[:PREFETCH_TOP_K - 1]
+    
     def data_acquisition_page(self):
         """数据获取页面"""
         st.title("📥 股票数据获取")
@@ -526,6 +898,10 @@ class StockAnalysisSystem:
                             else:
                                 st.error(f"{symbol} 数据保存失败")
                     
+                    # 全部保存后统一更新统计信息，便于查询优化器选用覆盖索引
+                    if data_dict:
+                        self.data_manager.analyze_database()
+                    
                     # 显示获取的股票列表
                     if data_dict:
                         st.subheader("获取的股票列表")
@@ -548,17 +924,26 @@ class StockAnalysisSystem:
         stored_symbols = self.data_manager.get_stored_symbols()
         
         if stored_symbols:
+            # 优先预取最近查看过的股票，其余按列表顺序补足
+            recent = [s for s in st.session_state.get('recent_symbols', []) if s in stored_symbols]
+            candidates = recent + [s for s in stored_symbols if s not in recent]
+            self.data_manager.prefetch_stock_data(candidates[:PREFETCH_TOP_K])
+            
             cols = st.columns(4)
             for idx, symbol in enumerate(stored_symbols):
                 with cols[idx % 4]:
                     if st.button(f"📈 {symbol}", key=f"btn_{symbol}"):
                         st.session_state['selected_symbol'] = symbol
+                        self.remember_symbol(symbol)
                         st.rerun()
         else:
             st.info("暂无存储的股票数据")
     
     def data_view_page(self):
         """数据查看页面"""
+        import plotly.express as px
+        import plotly.graph_objects as go
+        
         st.title("📊 数据查看与分析")
         
         # 选择股票
@@ -575,6 +960,8 @@ class StockAnalysisSystem:
         )
         
         if selected_symbol:
+            self.remember_symbol(selected_symbol)
+            
             # 获取数据
             data = self.data_manager.get_stock_data(selected_symbol)
             
@@ -585,6 +972,10 @@ class StockAnalysisSystem:
                 
                 st.markdown("---")
                 
+                # 日收益率直接基于收盘价数组计算，摘要指标与统计分析共用
+                close = data['Close'].to_numpy(dtype=float)
+                daily_returns = np.diff(close) / close[:-1]
+                
                 # 显示数据摘要
                 col1, col2, col3, col4, col5 = st.columns(5)
                 
@@ -595,10 +986,10 @@ class StockAnalysisSystem:
                 with col3:
                     st.metric("结束日期", str(data.index.max().date()))
                 with col4:
-                    returns = (data['Close'].iloc[-1] / data['Close'].iloc[0] - 1) * 100
+                    returns = (close[-1] / close[0] - 1) * 100
                     st.metric("期间收益率", f"{returns:.2f}%")
                 with col5:
-                    volatility = data['Close'].pct_change().std() * np.sqrt(252) * 100
+                    volatility = np.nanstd(daily_returns, ddof=1) * np.sqrt(252) * 100
                     st.metric("年化波动率", f"{volatility:.2f}%")
                 
                 st.markdown("---")
@@ -641,12 +1032,14 @@ class StockAnalysisSystem:
                         ma_period = st.slider("移动平均周期", 5, 200, 50)
                         data[f'MA{ma_period}'] = data['Close'].rolling(window=ma_period).mean()
                         
+                        plot_data = _downsample(data, 'Close')
+                        
                         fig_ma = go.Figure()
                         fig_ma.add_trace(go.Scatter(
-                            x=data.index, y=data['Close'], name='Close', line=dict(color='blue')
+                            x=plot_data.index, y=plot_data['Close'], name='Close', line=dict(color='blue')
                         ))
                         fig_ma.add_trace(go.Scatter(
-                            x=data.index, y=data[f'MA{ma_period}'], 
+                            x=plot_data.index, y=plot_data[f'MA{ma_period}'], 
                             name=f'MA{ma_period}', line=dict(color='red', dash='dash')
                         ))
                         fig_ma.update_layout(title=f"{selected_symbol} 移动平均线", height=400)
@@ -655,25 +1048,27 @@ class StockAnalysisSystem:
                     with col2:
                         # 布林带
                         bb_period = st.slider("布林带周期", 10, 100, 20)
-                        data['BB_Middle'] = data['Close'].rolling(window=bb_period).mean()
-                        bb_std = data['Close'].rolling(window=bb_period).std()
-                        data['BB_Upper'] = data['BB_Middle'] + 2 * bb_std
-                        data['BB_Lower'] = data['BB_Middle'] - 2 * bb_std
+                        bb_mid, bb_std = _rolling_mean_std(data['Close'].to_numpy(dtype=float), bb_period)
+                        data['BB_Middle'] = bb_mid
+                        data['BB_Upper'] = bb_mid + 2 * bb_std
+                        data['BB_Lower'] = bb_mid - 2 * bb_std
+                        
+                        plot_data = _downsample(data, 'Close')
                         
                         fig_bb = go.Figure()
                         fig_bb.add_trace(go.Scatter(
-                            x=data.index, y=data['Close'], name='Close', line=dict(color='blue')
+                            x=plot_data.index, y=plot_data['Close'], name='Close', line=dict(color='blue')
                         ))
                         fig_bb.add_trace(go.Scatter(
-                            x=data.index, y=data['BB_Upper'], 
+                            x=plot_data.index, y=plot_data['BB_Upper'], 
                             name='Upper Band', line=dict(color='gray', dash='dash')
                         ))
                         fig_bb.add_trace(go.Scatter(
-                            x=data.index, y=data['BB_Middle'], 
+                            x=plot_data.index, y=plot_data['BB_Middle'], 
                             name='Middle Band', line=dict(color='red', dash='dash')
                         ))
                         fig_bb.add_trace(go.Scatter(
-                            x=data.index, y=data['BB_Lower'], 
+                            x=plot_data.index, y=plot_data['BB_Lower'], 
                             name='Lower Band', line=dict(color='gray', dash='dash'),
                             fill='tonexty', fillcolor='rgba(128, 128, 128, 0.1)'
                         ))
@@ -684,7 +1079,7 @@ class StockAnalysisSystem:
                     # 统计分析
                     st.subheader("收益率分布")
                     
-                    returns = data['Close'].pct_change().dropna()
+                    returns = pd.Series(daily_returns, index=data.index[1:], name='Close').dropna()
                     
                     col1, col2 = st.columns(2)
                     
@@ -717,12 +1112,11 @@ class StockAnalysisSystem:
                         
                         # Q-Q图
                         st.subheader("正态性检验 - Q-Q图")
-                        import scipy.stats as stats
                         
                         fig_qq = go.Figure()
                         
                         # 计算理论分位数
-                        (osm, osr), (slope, intercept, r) = stats.probplot(returns, dist="norm")
+                        (osm, osr), (slope, intercept, r) = _probplot(returns.to_numpy())
                         
                         fig_qq.add_trace(go.Scatter(
                             x=osm, y=osr, mode='markers', name='样本分位数'
@@ -811,17 +1205,17 @@ class StockAnalysisSystem:
                                     mime="text/csv"
                                 )
                             elif export_format == "Excel":
-                                excel_buffer = pd.ExcelWriter("temp.xlsx", engine='openpyxl')
-                                data.to_excel(excel_buffer, sheet_name=export_symbol)
-                                excel_buffer.close()
+                                # 在内存中生成Excel文件，不落盘
+                                excel_buffer = io.BytesIO()
+                                with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
+                                    data.to_excel(writer, sheet_name=export_symbol)
                                 
-                                with open("temp.xlsx", "rb") as f:
-                                    st.download_button(
-                                        label="下载Excel文件",
-                                        data=f,
-                                        file_name=f"{export_symbol}_stock_data.xlsx",
-                                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                                    )
+                                st.download_button(
+                                    label="下载Excel文件",
+                                    data=excel_buffer.getvalue(),
+                                    file_name=f"{export_symbol}_stock_data.xlsx",
+                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                                )
                             elif export_format == "JSON":
                                 json_str = data.to_json(orient='records', date_format='iso')
                                 st.download_button(
@@ -844,30 +1238,23 @@ class StockAnalysisSystem:
             with col2:
                 st.metric("数据目录", str(DATA_DIR))
             
-            # 数据库优化选项
+            # 数据库优化选项：默认只回收空闲页，完整VACUUM会重写整个文件
+            vacuum_pages = st.number_input("每次回收页数", min_value=100, max_value=100000, value=1000, step=100)
             if st.button("优化数据库", type="secondary"):
-                try:
-                    conn = sqlite3.connect(self.data_manager.db_path)
-                    conn.execute("VACUUM")
-                    conn.close()
+                if self.data_manager.vacuum_database(pages=vacuum_pages):
                     st.success("数据库优化完成")
-                except Exception as e:
-                    st.error(f"优化失败: {str(e)}")
+            
+            if st.button("完整VACUUM（较慢）", type="secondary"):
+                with st.spinner("正在重建数据库..."):
+                    if self.data_manager.vacuum_database(full=True):
+                        st.success("完整VACUUM完成")
             
             # 清空所有数据
             if st.button("清空所有数据", type="primary"):
                 if st.checkbox("确认要清空所有数据？此操作不可恢复！"):
-                    try:
-                        conn = sqlite3.connect(self.data_manager.db_path)
-                        cursor = conn.cursor()
-                        cursor.execute("DELETE FROM stocks")
-                        cursor.execute("DELETE FROM stock_info")
-                        conn.commit()
-                        conn.close()
+                    if self.data_manager.clear_all_data():
                         st.success("已清空所有数据")
                         st.rerun()
-                    except Exception as e:
-                        st.error(f"清空失败: {str(e)}")
     
     def system_settings_page(self):
         """系统设置页面"""
@@ -885,14 +1272,17 @@ class StockAnalysisSystem:
                 disabled=True
             )
             
+            settings = _load_settings(_settings_mtime())
+            
             # 缓存设置
-            cache_enabled = st.checkbox("启用数据缓存", value=True)
-            cache_duration = st.slider("缓存时间(天)", 1, 30, 7)
+            cache_enabled = st.checkbox("启用数据缓存", value=settings['cache_enabled'])
+            cache_duration = st.slider("缓存时间(天)", 1, 30, settings['cache_duration'])
             
             # 自动更新设置
-            auto_update = st.checkbox("启用自动数据更新")
+            auto_update = st.checkbox("启用自动数据更新", value=settings['auto_update'])
             if auto_update:
-                update_time = st.time_input("每日更新时间", value=datetime.strptime("16:00", "%H:%M").time())
+                saved_time = (settings['update_time'] or "16:00:00")[:5]
+                update_time = st.time_input("每日更新时间", value=datetime.strptime(saved_time, "%H:%M").time())
             
             # 保存设置
             if st.button("保存设置"):
@@ -903,8 +1293,9 @@ class StockAnalysisSystem:
                     'update_time': str(update_time) if auto_update else None
                 }
                 
-                with open(DATA_DIR / "settings.json", "w") as f:
+                with open(SETTINGS_PATH, "w") as f:
                     json.dump(settings, f)
+                _load_settings.clear()
                 
                 st.success("设置已保存")
         
@@ -1,11 +1,19 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import akshare as ak
 import pandas as pd
 import sqlite3
 from datetime import datetime, timedelta
 import os
+import sys
 import time
 import random
+import re
+import threading
+from collections import deque
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
@@ -13,16 +21,50 @@ from urllib3.util.retry import Retry
 # -------------------------- 全局配置 --------------------------
 # 配置参数
 REQUEST_CONFIG = {
-    'min_delay': 3,      # 最小延迟秒数
-    'max_delay': 5,      # 最大延迟秒数
+    'min_delay': 3,      # 重试前随机延迟的最小秒数
+    'max_delay': 5,      # 重试前随机延迟的最大秒数
     'max_retries': 3,    # 最大重试次数
     'timeout': 30,       # 请求超时时间
+    'max_concurrency': 3,  # 同时抓取的股票数量
+    'rate_limit': 20,    # 每分钟最多请求次数（全局共享）
 }
 
+# 股票代码分隔符：中英文逗号、分号及空白
+SYMBOL_SEPARATOR = re.compile(r'[,\s;，；]+')
+
+# 进度条/状态文字两次刷新的最小间隔（秒）
+UI_UPDATE_INTERVAL = 0.25
+
+# 由safe_fetch_stock_data退避重试的HTTP状态码（限流及服务端临时错误）
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# stock_zh_a_hist表的插入列（与INSERT语句中的列顺序一致）
+INSERT_COLUMNS = [
+    "symbol", "date", "open", "close", "high", "low", "volume", "amount",
+    "amplitude", "change_percent", "change", "turnover", "period", "adjust"
+]
+
+# 处理后数据必须包含的列
+REQUIRED_COLUMNS = ["date", "open", "close", "high", "low", "volume"]
+
+# 查询结果的列类型：价格类字段用float32即可满足展示精度，成交量/成交额数值较大保留float64
+QUERY_DTYPES = {
+    "open": "float32", "close": "float32", "high": "float32", "low": "float32",
+    "amplitude": "float32", "change_percent": "float32", "change": "float32", "turnover": "float32",
+    "volume": "float64", "amount": "float64",
+}
+
+# 查询结果每次从游标读取的行数
+QUERY_CHUNK_ROWS = 50_000
+
+# stock_zh_a_hist的主键列（WITHOUT ROWID表按主键顺序聚簇存储，
+# 与查询条件symbol IN (...) AND period=? AND adjust=? AND date范围的顺序一致）
+PRIMARY_KEY_COLUMNS = ("symbol", "period", "adjust", "date")
+
 # -------------------------- 反爬虫配置（优化版） --------------------------
 def create_session_with_retry():
-    """创建带重试机制的requests会话"""
-    session = requests.Session()
+    """创建requests会话：每个HTTP请求都经过全局限流，重试统一交给safe_fetch_stock_data"""
+    session = RateLimitedSession()
     
     # 设置随机User-Agent
     user_agents = [
@@ -38,26 +80,18 @@ def create_session_with_retry():
         'User-Agent': random.choice(user_agents),
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
         'Accept-Language': 'zh-CN,zh;q=0.8,zh-TW;q=0.7,zh-HK;q=0.5,en-US;q=0.3,en;q=0.2',
-        'Connection': 'close',  # 每次请求后关闭连接
         'Upgrade-Insecure-Requests': '1',
     })
     
-    # 设置重试机制（优化版）
-    retry_strategy = Retry(
-        total=REQUEST_CONFIG['max_retries'],
-        backoff_factor=2,  # 增加退避因子
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["GET", "POST"],
-        raise_on_status=False
-    )
-    
+    # 连接层不自动重试（否则重试请求绕过限流器），限流/服务端错误状态转为异常由应用层退避重试
     adapter = HTTPAdapter(
-        max_retries=retry_strategy,
-        pool_connections=10,
-        pool_maxsize=10
+        max_retries=Retry(total=0, read=False),
+        pool_connections=32,
+        pool_maxsize=32
     )
     session.mount("http://", adapter)
     session.mount("https://", adapter)
+    session.hooks["response"].append(raise_for_retry_status)
     
     return session
 
@@ -68,19 +102,84 @@ def add_random_delay(min_seconds=None, max_seconds=None):
     delay = random.uniform(min_sec, max_sec)
     time.sleep(delay)
 
+class RateLimiter:
+    """线程安全的滑动窗口限流器：任意window秒内最多放行max_calls次请求，未超限时不等待"""
+    
+    def __init__(self, max_calls, window=60):
+        self.max_calls = max_calls
+        self.window = window
+        self._calls = deque()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """获取一次请求许可，超出限额时阻塞到窗口内最早的请求过期"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.window:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                wait = self.window - (now - self._calls[0])
+            time.sleep(wait)
+
+@st.cache_resource
+def get_rate_limiter(max_calls, window=60):
+    """进程内共享的限流器（跨脚本重跑保留请求记录）"""
+    return RateLimiter(max_calls, window)
+
+class RateLimitedSession(requests.Session):
+    """实际发出每个HTTP请求（含重定向）前先获取一次全局限流许可"""
+    
+    def send(self, request, **kwargs):
+        get_rate_limiter(REQUEST_CONFIG['rate_limit']).acquire()
+        return super().send(request, **kwargs)
+
+def raise_for_retry_status(response, *args, **kwargs):
+    """响应钩子：RETRY_STATUS_CODES中的状态码抛出HTTPError"""
+    if response.status_code in RETRY_STATUS_CODES:
+        response.raise_for_status()
+
+def create_script_executor(max_workers):
+    """创建工作线程池，工作线程继承当前Streamlit脚本上下文，可在其中调用st.*"""
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=partial(add_script_run_ctx, None, ctx)
+    )
+
+def bind_session_to_akshare(session):
+    """让akshare历史行情接口复用同一个session（保持长连接，避免每次请求重新握手）"""
+    module = sys.modules[ak.stock_zh_a_hist.__module__]
+    if getattr(module, "requests", None) is requests:
+        module.requests = session
+
+def make_progress_updater(progress_bar, status_text=None, interval=UI_UPDATE_INTERVAL):
+    """返回节流的进度更新函数：两次界面刷新至少间隔interval秒，最后一项总会刷新"""
+    last_update = 0.0
+    
+    def update(done, total, message=None):
+        nonlocal last_update
+        now = time.monotonic()
+        if done < total and now - last_update < interval:
+            return
+        last_update = now
+        progress_bar.progress(done / total)
+        if status_text is not None and message:
+            status_text.text(message)
+    
+    return update
+
 # 初始化session
 session = create_session_with_retry()
+bind_session_to_akshare(session)
 
 # -------------------------- 数据库配置（优化版） --------------------------
-def init_db(db_path="quant_data.db"):
-    """初始化数据库，创建股票数据表格"""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # 股票历史数据表（添加索引提高查询性能）
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS stock_zh_a_hist (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
+def create_hist_table(cursor, table_name="stock_zh_a_hist"):
+    """创建股票历史数据表（以复合主键去重，无自增id）"""
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS {table_name} (
         symbol TEXT NOT NULL,
         date DATE NOT NULL,
         open REAL,
@@ -96,24 +195,100 @@ def init_db(db_path="quant_data.db"):
         period TEXT DEFAULT 'daily',
         adjust TEXT DEFAULT 'qfq',
         create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(symbol, date, period, adjust)
-    )
+        PRIMARY KEY ({", ".join(PRIMARY_KEY_COLUMNS)})
+    ) WITHOUT ROWID
     ''')
+
+def migrate_hist_table(cursor):
+    """主键与PRIMARY_KEY_COLUMNS不一致的旧表（如带自增id的表）按新结构重建，保留原有数据"""
+    pk_columns = tuple(
+        row["name"] for row in sorted(
+            cursor.execute("PRAGMA table_info(stock_zh_a_hist)").fetchall(),
+            key=lambda row: row["pk"]
+        ) if row["pk"]
+    )
+    if not pk_columns or pk_columns == PRIMARY_KEY_COLUMNS:
+        return
+    
+    columns = INSERT_COLUMNS + ["create_time"]
+    # 旧表的period/adjust允许NULL，按列默认值补齐后再写入新主键
+    defaults = {"period": "'daily'", "adjust": "'qfq'"}
+    select_list = ", ".join(
+        f"COALESCE({col}, {defaults[col]})" if col in defaults else col
+        for col in columns
+    )
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("DROP TABLE IF EXISTS stock_zh_a_hist_new")
+        create_hist_table(cursor, "stock_zh_a_hist_new")
+        # INSERT ... SELECT后接ON CONFLICT时需带WHERE子句，否则SQLite解析有歧义
+        cursor.execute(f'''
+        INSERT INTO stock_zh_a_hist_new ({", ".join(columns)})
+        SELECT {select_list} FROM stock_zh_a_hist WHERE true
+        ON CONFLICT ({", ".join(PRIMARY_KEY_COLUMNS)}) DO NOTHING
+        ''')
+        copied = cursor.rowcount
+        total = cursor.execute("SELECT COUNT(*) FROM stock_zh_a_hist").fetchone()[0]
+        cursor.execute("DROP TABLE stock_zh_a_hist")
+        cursor.execute("ALTER TABLE stock_zh_a_hist_new RENAME TO stock_zh_a_hist")
+        cursor.connection.commit()
+    except Exception:
+        cursor.connection.rollback()
+        raise
+    
+    if total > copied:
+        st.warning(f"迁移旧表时合并了{total - copied}条主键重复的记录")
+
+def init_db(db_path="quant_data.db"):
+    """初始化数据库，创建股票数据表格"""
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    
+    # 股票历史数据表（(symbol, period, adjust, date)作主键，同时承担去重和按股票查询，无需额外索引）
+    migrate_hist_table(cursor)
+    create_hist_table(cursor)
     
-    # 创建索引
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_symbol_date ON stock_zh_a_hist(symbol, date)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_symbol ON stock_zh_a_hist(symbol)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_date ON stock_zh_a_hist(date)')
+    # 收集统计信息供查询规划器使用
+    cursor.execute('ANALYZE')
     
     conn.commit()
     conn.close()
 
+class OptimizingConnection(sqlite3.Connection):
+    """关闭前执行PRAGMA optimize，只对统计信息过期的表重新ANALYZE，开销很小"""
+    
+    def close(self):
+        try:
+            self.execute("PRAGMA optimize")
+        except sqlite3.Error:
+            pass
+        super().close()
+
 def get_db_connection(db_path="quant_data.db"):
     """获取数据库连接"""
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, factory=OptimizingConnection)
     conn.row_factory = sqlite3.Row
+    # WAL模式持久保存在数据库文件中；其余PRAGMA为连接级设置，每次连接时都需设置
+    conn.executescript('''
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    PRAGMA mmap_size=268435456;
+    ''')
     return conn
 
+def insert_rows(conn, rows):
+    """批量插入stock_zh_a_hist，主键冲突的重复数据跳过，返回实际新增行数"""
+    cursor = conn.executemany(
+        f"INSERT INTO stock_zh_a_hist ({', '.join(INSERT_COLUMNS)}) "
+        f"VALUES ({', '.join('?' * len(INSERT_COLUMNS))}) "
+        f"ON CONFLICT({', '.join(PRIMARY_KEY_COLUMNS)}) DO NOTHING",
+        rows
+    )
+    # executemany的rowcount为所有行的修改数之和
+    return cursor.rowcount
+
 # -------------------------- 核心数据获取函数（优化版） --------------------------
 def safe_fetch_stock_data(symbol, start_date, end_date, period="daily", adjust="qfq", max_retries=None):
     """
@@ -123,10 +298,7 @@ def safe_fetch_stock_data(symbol, start_date, end_date, period="daily", adjust="
     
     for attempt in range(max_retries):
         try:
-            # 添加随机延迟（每次请求前都延迟）
-            add_random_delay()
-            
-            # 准备参数
+            # 准备参数（全局限流在session发出每个HTTP请求时进行）
             adjust_param = adjust if adjust != "None" else ""
             
             # 使用akshare获取数据（添加超时控制）
@@ -149,6 +321,7 @@ def safe_fetch_stock_data(symbol, start_date, end_date, period="daily", adjust="
                 wait_time = 2 ** (attempt + 1)  # 指数退避
                 st.warning(f"第{attempt+1}次请求失败，{wait_time}秒后重试: {str(e)[:100]}")
                 time.sleep(wait_time)
+                add_random_delay()  # 重试前附加随机抖动
             else:
                 st.error(f"获取股票{symbol}数据失败（已重试{max_retries}次）")
                 return None
@@ -158,25 +331,29 @@ def safe_fetch_stock_data(symbol, start_date, end_date, period="daily", adjust="
 
 def process_stock_data(df, symbol, period, adjust):
     """统一处理股票数据格式"""
-    # 重置索引
-    if "date" not in df.columns:
-        df = df.reset_index()
-    
-    # 统一列名
-    column_mapping = {
-        "日期": "date", "trade_date": "date", "index": "date",
-        "开盘": "open", "收盘": "close", "最高": "high", "最低": "low",
-        "成交量": "volume", "成交额": "amount", "振幅": "amplitude",
-        "涨跌幅": "change_percent", "涨跌额": "change", "换手率": "turnover"
-    }
-    
-    df = df.rename(columns={k: v for k, v in column_mapping.items() if k in df.columns})
+    # 已是标准列名的数据跳过重置索引和重命名
+    if not set(REQUIRED_COLUMNS).issubset(df.columns):
+        # 重置索引（日期在索引中时才需要，否则会多出一列index与日期列重名）
+        if not any(col in df.columns for col in ("date", "日期", "trade_date")):
+            df = df.reset_index()
+        
+        # 统一列名
+        column_mapping = {
+            "日期": "date", "trade_date": "date", "index": "date",
+            "开盘": "open", "收盘": "close", "最高": "high", "最低": "low",
+            "成交量": "volume", "成交额": "amount", "振幅": "amplitude",
+            "涨跌幅": "change_percent", "涨跌额": "change", "换手率": "turnover"
+        }
+        
+        df = df.rename(columns={k: v for k, v in column_mapping.items() if k in df.columns})
     
-    # 处理日期列
+    # 处理日期列（用NumPy按天截断后整体转为ISO字符串，代替逐行strftime）
     if "date" in df.columns:
-        df["date"] = pd.to_datetime(df["date"], errors='coerce')
+        if not pd.api.types.is_datetime64_any_dtype(df["date"]):
+            # 按ISO 8601格式解析（兼容YYYY-MM-DD与YYYYMMDD），不逐个推断格式；重复日期只解析一次
+            df["date"] = pd.to_datetime(df["date"], format='ISO8601', errors='coerce', cache=True)
         df = df.dropna(subset=["date"])
-        df["date"] = df["date"].dt.strftime("%Y-%m-%d")
+        df["date"] = df["date"].values.astype("datetime64[D]").astype(str)
     
     # 添加元数据
     df["symbol"] = symbol
@@ -184,19 +361,36 @@ def process_stock_data(df, symbol, period, adjust):
     df["adjust"] = adjust if adjust != "" else "None"
     
     # 确保必要的列存在
-    required_columns = ["date", "open", "close", "high", "low", "volume"]
-    for col in required_columns:
+    for col in REQUIRED_COLUMNS:
         if col not in df.columns:
             df[col] = None
     
+    # 成交量为整数，无损压缩为最小的无符号整数类型；价格保持float64，避免float32误差写入数据库
+    df["volume"] = pd.to_numeric(df["volume"], downcast="unsigned")
+    
     return df
 
 # -------------------------- 批量操作函数（优化版） --------------------------
 def process_symbols(symbols_str):
-    """处理股票代码字符串，返回清理后的列表"""
-    symbols = symbols_str.replace('，', ',').replace(';', ',').replace(' ', ',')
-    symbols = [s.strip() for s in symbols.split(',') if s.strip()]
-    return list(set(symbols))
+    """处理股票代码字符串，返回去重排序后的元组（可直接用作缓存键）"""
+    return tuple(sorted({s for s in SYMBOL_SEPARATOR.split(symbols_str) if s}))
+
+async def fetch_stocks_concurrently(symbols, start_date, end_date, period, adjust, on_result):
+    """并发获取多只股票数据，同时进行的请求不超过max_concurrency个"""
+    loop = asyncio.get_running_loop()
+    max_concurrency = REQUEST_CONFIG['max_concurrency']
+    semaphore = asyncio.Semaphore(max_concurrency)
+    
+    with create_script_executor(max_concurrency) as executor:
+        async def fetch(symbol):
+            async with semaphore:
+                # akshare为同步接口，放入线程池执行（请求频率由全局限流器控制）
+                df = await loop.run_in_executor(
+                    executor, safe_fetch_stock_data, symbol, start_date, end_date, period, adjust
+                )
+                on_result(symbol, df)
+        
+        await asyncio.gather(*(fetch(symbol) for symbol in symbols))
 
 def fetch_multiple_stocks(symbols_str, start_date, end_date, period="daily", adjust="qfq"):
     """批量获取多个股票的数据"""
@@ -208,20 +402,18 @@ def fetch_multiple_stocks(symbols_str, start_date, end_date, period="daily", adj
     results = []
     progress_bar = st.progress(0)
     status_text = st.empty()
+    update_progress = make_progress_updater(progress_bar, status_text)
+    completed = 0
     
-    for i, symbol in enumerate(symbols):
-        progress = i / len(symbols)
-        progress_bar.progress(progress)
-        status_text.text(f"正在获取 {symbol} ({i+1}/{len(symbols)})...")
-        
-        df = safe_fetch_stock_data(symbol, start_date, end_date, period, adjust)
-        
+    # 回调在事件循环所在的脚本线程中执行，可直接更新界面
+    def on_result(symbol, df):
+        nonlocal completed
+        completed += 1
         if df is not None and not df.empty:
             results.append(df)
-        
-        # 额外的请求间延迟
-        if i < len(symbols) - 1:
-            add_random_delay(2, 4)
+        update_progress(completed, len(symbols), f"已完成 {symbol} ({completed}/{len(symbols)})...")
+    
+    asyncio.run(fetch_stocks_concurrently(symbols, start_date, end_date, period, adjust, on_result))
     
     progress_bar.progress(1.0)
     success_count = len(results)
@@ -235,53 +427,56 @@ def save_stocks_to_db(df_list, db_path="quant_data.db"):
         st.warning("无数据可存储")
         return 0
     
-    total_inserted = 0
-    conn = get_db_connection(db_path)
+    summary = []  # (股票代码, 新增条数)，最后统一展示
+    errors = []   # (股票代码, 错误信息)
     
+    # 按插入列顺序整理数据（缺失的列以空值补齐），整体转换为元组列表
+    batches = []
     for df in df_list:
         if df.empty:
             continue
-        
         symbol = df["symbol"].iloc[0]
-        inserted = 0
-        
         try:
-            # 使用批量插入提高性能
-            data_to_insert = []
-            for _, row in df.iterrows():
-                data_to_insert.append((
-                    row.get("symbol"),
-                    row.get("date"),
-                    row.get("open"), row.get("close"),
-                    row.get("high"), row.get("low"),
-                    row.get("volume"), row.get("amount"),
-                    row.get("amplitude"), row.get("change_percent"),
-                    row.get("change"), row.get("turnover"),
-                    row.get("period", "daily"),
-                    row.get("adjust", "qfq")
-                ))
-            
-            # 使用INSERT OR IGNORE避免重复
-            conn.executemany('''
-            INSERT OR IGNORE INTO stock_zh_a_hist 
-            (symbol, date, open, close, high, low, volume, amount, 
-             amplitude, change_percent, change, turnover, period, adjust)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', data_to_insert)
-            
-            inserted = conn.total_changes
-            total_inserted += inserted
-            
-            if inserted > 0:
-                st.success(f"{symbol}: 新增 {inserted} 条数据")
-                
+            batches.append((symbol, list(
+                df.reindex(columns=INSERT_COLUMNS)
+                .fillna({"period": "daily", "adjust": "qfq"})
+                .itertuples(index=False, name=None)
+            )))
         except Exception as e:
-            st.error(f"{symbol} 存储失败: {str(e)[:100]}")
-            conn.rollback()
+            errors.append((symbol, str(e)))
     
-    conn.commit()
-    conn.close()
+    conn = get_db_connection(db_path)
+    # 批量导入期间关闭同步刷盘（数据可重新抓取，不要求掉电持久性）
+    conn.execute("PRAGMA synchronous=OFF")
+    
+    try:
+        # 快速路径：所有股票在同一个写事务中插入，只提交一次
+        conn.execute("BEGIN IMMEDIATE")
+        for symbol, rows in batches:
+            summary.append((symbol, insert_rows(conn, rows)))
+        conn.commit()
+    except Exception:
+        # 整批失败时回滚，逐个股票单独提交，定位出错的股票
+        conn.rollback()
+        summary = []
+        for symbol, rows in batches:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                inserted = insert_rows(conn, rows)
+                conn.commit()
+                summary.append((symbol, inserted))
+            except Exception as e:
+                conn.rollback()
+                errors.append((symbol, str(e)))
+    finally:
+        conn.close()
     
+    for symbol, error in errors:
+        st.error(f"{symbol} 存储失败: {error[:100]}")
+    
+    total_inserted = sum(inserted for _, inserted in summary)
+    if summary:
+        st.dataframe(pd.DataFrame(summary, columns=["股票代码", "新增条数"]), hide_index=True)
     st.info(f"总计新增 {total_inserted} 条数据")
     return total_inserted
 
@@ -321,35 +516,39 @@ def update_multiple_stocks(symbols_str, period="daily", adjust="qfq", db_path="q
     
     results = []
     progress_bar = st.progress(0)
-    
-    for i, symbol in enumerate(symbols):
-        progress = i / len(symbols)
-        progress_bar.progress(progress)
-        
-        df = update_stock_data(symbol, period, adjust, db_path)
-        if df is not None and not df.empty:
-            results.append(df)
-        
-        if i < len(symbols) - 1:
-            add_random_delay(2, 4)
+    update_progress = make_progress_updater(progress_bar)
+    
+    # 增量更新以网络等待为主，多只股票并行执行；每次调用各自打开数据库连接，请求频率由全局限流器控制
+    with create_script_executor(REQUEST_CONFIG['max_concurrency']) as executor:
+        futures = [
+            executor.submit(update_stock_data, symbol, period, adjust, db_path)
+            for symbol in symbols
+        ]
+        for i, future in enumerate(as_completed(futures), start=1):
+            df = future.result()
+            if df is not None and not df.empty:
+                results.append(df)
+            update_progress(i, len(symbols))
     
     progress_bar.progress(1.0)
     return results
 
 # -------------------------- 数据查询函数（优化版） --------------------------
-def query_stocks_data(symbols_str, start_date=None, end_date=None, period="daily", adjust="qfq", db_path="quant_data.db"):
-    """从数据库查询股票数据"""
-    symbols = process_symbols(symbols_str)
-    if not symbols:
-        return pd.DataFrame()
-    
-    placeholders = ','.join(['?'] * len(symbols))
+def get_db_mtime(db_path):
+    """数据库最近修改时间（WAL模式下写入先落在-wal文件中，一并计入）"""
+    mtimes = [os.stat(p).st_mtime_ns for p in (db_path, db_path + "-wal") if os.path.exists(p)]
+    return max(mtimes, default=0)
+
+@st.cache_data(show_spinner=False)
+def _query_impl(symbols_tuple, start_date, end_date, period, adjust, db_path, db_mtime):
+    """执行查询并缓存结果；db_mtime仅作为缓存键，数据库写入后自动失效"""
+    placeholders = ','.join(['?'] * len(symbols_tuple))
     query = f'''
-    SELECT * FROM stock_zh_a_hist 
+    SELECT {', '.join(INSERT_COLUMNS)} FROM stock_zh_a_hist 
     WHERE symbol IN ({placeholders}) AND period=? AND adjust=?
     '''
     
-    params = symbols + [period, adjust if adjust != "None" else ""]
+    params = list(symbols_tuple) + [period, adjust if adjust != "None" else ""]
     
     if start_date:
         query += " AND date >= ?"
@@ -361,13 +560,36 @@ def query_stocks_data(symbols_str, start_date=None, end_date=None, period="daily
     query += " ORDER BY symbol, date ASC"
     
     conn = get_db_connection(db_path)
+    conn.row_factory = None  # 直接返回元组，省去sqlite3.Row的封装
     try:
-        df = pd.read_sql(query, conn, params=params)
+        cursor = conn.execute(query, params)
+        columns = [desc[0] for desc in cursor.description]
+        dtypes = {col: dtype for col, dtype in QUERY_DTYPES.items() if col in columns}
+        
+        # 分块读取并逐块转换类型，内存中同时只保留一块Python元组
+        chunks = []
+        while rows := cursor.fetchmany(QUERY_CHUNK_ROWS):
+            chunks.append(pd.DataFrame.from_records(rows, columns=columns).astype(dtypes))
+        if not chunks:
+            return pd.DataFrame(columns=columns).astype(dtypes)
+        return pd.concat(chunks, ignore_index=True)
+    finally:
+        conn.close()
+
+def query_stocks_data(symbols_str, start_date=None, end_date=None, period="daily", adjust="qfq", db_path="quant_data.db"):
+    """从数据库查询股票数据"""
+    symbols = process_symbols(symbols_str)
+    if not symbols:
+        return pd.DataFrame()
+    
+    try:
+        df = _query_impl(
+            symbols, start_date, end_date, period, adjust,
+            db_path, get_db_mtime(db_path)
+        )
     except Exception as e:
         st.error(f"查询失败: {str(e)}")
         df = pd.DataFrame()
-    finally:
-        conn.close()
     
     return df
 
@@ -389,8 +611,9 @@ def main():
     st.sidebar.subheader("🛡️ 反爬虫设置")
     enable_antispider = st.sidebar.checkbox("启用反爬虫保护", value=True)
     if enable_antispider:
-        REQUEST_CONFIG['min_delay'] = st.sidebar.slider("最小延迟(秒)", 1.0, 5.0, 3.0, 0.5)
-        REQUEST_CONFIG['max_delay'] = st.sidebar.slider("最大延迟(秒)", 2.0, 10.0, 5.0, 0.5)
+        REQUEST_CONFIG['rate_limit'] = st.sidebar.slider("每分钟最多请求数", 5, 60, 20, 5)
+        REQUEST_CONFIG['min_delay'] = st.sidebar.slider("重试最小延迟(秒)", 1.0, 5.0, 3.0, 0.5)
+        REQUEST_CONFIG['max_delay'] = st.sidebar.slider("重试最大延迟(秒)", 2.0, 10.0, 5.0, 0.5)
         REQUEST_CONFIG['max_retries'] = st.sidebar.slider("最大重试次数", 1, 5, 3)
     
     # 主功能选择
@@ -452,7 +675,8 @@ def main():
                 if df_list:
                     st.subheader("📊 价格走势图")
                     chart_data = pd.concat(df_list[:5])  # 最多显示5个股票
-                    pivot_df = chart_data.pivot_table(
+                    # 每个(日期, 股票)只保留一行后直接pivot，无需pivot_table的聚合
+                    pivot_df = chart_data.drop_duplicates(['date', 'symbol'], keep='last').pivot(
                         index='date', 
                         columns='symbol', 
                         values='close'
@@ -501,7 +725,8 @@ def main():
                 # 可视化
                 if df['symbol'].nunique() <= 10:
                     st.subheader("📈 多股票对比")
-                    pivot_df = df.pivot_table(index='date', columns='symbol', values='close')
+                    # 主键保证查询结果中(日期, 股票)唯一，可直接pivot
+                    pivot_df = df.pivot(index='date', columns='symbol', values='close')
                     st.line_chart(pivot_df)
             else:
                 st.warning("⚠️ 未查询到数据")